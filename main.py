@@ -1,13 +1,26 @@
 #!/usr/bin/env python3
 
 import argparse
-from datetime import datetime
+import hashlib
+import os
+import tempfile
+import time
+from collections.abc import Iterable
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import suppress
+from datetime import datetime, timedelta
 from functools import partial
-from typing import Literal
+from operator import itemgetter
+from pathlib import Path
+from typing import Any, Literal
+from urllib.parse import urlencode
 
 import inquirer
+import orjson
 import pandas as pd
 import requests
+import xlsxwriter
+from requests.adapters import HTTPAdapter
 
 UNIVERSITIES = [
     "unitn",
@@ -15,14 +28,39 @@ UNIVERSITIES = [
 
 CINECA_BASE_URL = "https://{university}.coursecatalogue.cineca.it/{path}"
 COURSE_CATALOGUE_PATH_TEMPLATE = "api/v1/corso/{aa}/{corso_cod}"
-COURSE_PATH_TEMPLATE = "insegnamenti/{aa}/{cod}/{ordinamento_aa}/{corso_percorso_id}/{corso_cod}"
+
+# NOTE: the XDG spec says to ignore an empty `XDG_CACHE_HOME`.
+CACHE_DIR = Path(os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache") / "cineca-choice-helper"
+CACHE_MAX_AGE = timedelta(days=7)
+
+# NOTE: `URL` is the hyperlink target of `Link`, it isn't written to the sheet as a column of its own.
+CATALOGUE_COLUMNS = ("Year", "Teaching", "Semester", "CFU", "Name", "Link", "URL")
+SHEET_COLUMNS = CATALOGUE_COLUMNS[:-1]
+
+
+def course_url(teachings_url: str, activity: dict) -> str:
+    return (
+        f"{teachings_url}/{activity['aa']}/{activity['cod']}"
+        f"/{activity['ordinamento_aa']}/{activity['corso_percorso_id']}/{activity['corso_cod']}"
+    )
+
+
+def compute_column_widths(columns: dict[str, Iterable]) -> dict[str, int]:
+    return {name: max(len(name), max(map(len, map(str, values)), default=0)) for name, values in columns.items()}
+
+
+def make_session() -> requests.Session:
+    session = requests.Session()
+    session.headers.update({"Accept": "application/json", "Accept-Encoding": "gzip"})
+    session.mount("https://", HTTPAdapter(pool_connections=2, pool_maxsize=4))
+    return session
 
 
 class Config:
-    def __init__(self, year: int, lang: Literal["en", "it"]):
+    def __init__(self, year: int, lang: Literal["en", "it"], university: str | None = None):
         self.year: int = year
         self.lang: Literal["en", "it"] = lang
-        self.university: str = self._select_university()
+        self.university: str = university or self._select_university()
 
     def _select_university(self) -> str:
         return inquirer.list_input("Select your University", choices=UNIVERSITIES)
@@ -41,75 +79,165 @@ class CourseChooser:
         self.keys = Keys(config.lang)
         self.cineca_base_url = partial(CINECA_BASE_URL.format, university=config.university)
 
+        self.session = make_session()
+        # NOTE: a single worker with its own session, `requests.Session` isn't documented as thread-safe.
+        self.prefetch_session = make_session()
+        self.prefetcher = ThreadPoolExecutor(max_workers=1)
+        self.prefetched_catalogues: dict[str, Future] = {}
+
         print(f"NOTE: if you don't know what to answer to the following questions take a look at: {self.cineca_base_url(path="")}")  # fmt: skip # noqa: E501
 
     def get_degree(self) -> str:
-        gruppi = requests.get(
-            self.cineca_base_url(path="api/v1/corsi"),
-            params={"anno": self.year, "minimal": "true"},
-            timeout=30,
-        ).json()
+        gruppi = self._get_json("api/v1/corsi", params={"anno": self.year, "minimal": "true"})
 
         group = self._select_with_des("Select the Degree type", gruppi)
         department = self._select_with_des("Select Department", group["subgroups"])
-        return self._select_with_des("Select Course", department["cds"])["cdsSub"][0]["cod"]
+
+        # NOTE: download the catalogues while the user is choosing the course, the unused ones are cancelled later.
+        for cds in department["cds"]:
+            cds_cod = cds["cdsSub"][0]["cod"]
+            self.prefetched_catalogues[cds_cod] = self.prefetcher.submit(
+                self._get_catalogue,
+                cds_cod,
+                self.prefetch_session,
+            )
+
+        try:
+            return self._select_with_des("Select Course", department["cds"])["cdsSub"][0]["cod"]
+        except BaseException:
+            # NOTE: e.g. Ctrl-C, otherwise the interpreter would wait for every queued download before exiting.
+            self._stop_prefetching()
+            raise
 
     def get_course_catalogue(self, cod: str) -> pd.DataFrame:
-        course_paths = requests.get(
-            self.cineca_base_url(path=COURSE_CATALOGUE_PATH_TEMPLATE.format(aa=self.year, corso_cod=cod)),
-            timeout=30,
-        ).json()["percorsi"]
+        prefetched = self.prefetched_catalogues.pop(cod, None)
+        # NOTE: a prefetch that hasn't started would wait behind the one in flight, it's fetched directly instead.
+        if prefetched is not None and prefetched.cancel():
+            prefetched = None
+        self._stop_prefetching()
+
+        course_paths = (prefetched.result() if prefetched else self._get_catalogue(cod))["percorsi"]
         courses = self._select_with_des("Select the study path", course_paths)
         return self._serialize_course_choices(courses)
 
+    def _stop_prefetching(self) -> None:
+        self.prefetched_catalogues.clear()
+        self.prefetcher.shutdown(wait=False, cancel_futures=True)
+
+    def _get_catalogue(self, cod: str, session: requests.Session | None = None) -> dict:
+        return self._get_json(COURSE_CATALOGUE_PATH_TEMPLATE.format(aa=self.year, corso_cod=cod), session=session)
+
+    def _get_json(
+        self,
+        path: str,
+        params: dict | None = None,
+        session: requests.Session | None = None,
+    ) -> Any:  # noqa: ANN401
+        url = self.cineca_base_url(path=path)
+        if params:
+            url = f"{url}?{urlencode(params)}"
+
+        cache_file = CACHE_DIR / f"{hashlib.blake2b(url.encode(), digest_size=16).hexdigest()}.json"
+        # NOTE: a missing, unreadable or corrupted entry is treated as a miss and downloaded again.
+        with suppress(OSError, orjson.JSONDecodeError):
+            if time.time() - cache_file.stat().st_mtime < CACHE_MAX_AGE.total_seconds():
+                return orjson.loads(cache_file.read_bytes())
+
+        response = (session or self.session).get(url, timeout=30)
+        response.raise_for_status()
+        data = orjson.loads(response.content)
+        self._write_cache(cache_file, response.content)
+        return data
+
+    @staticmethod
+    def _write_cache(cache_file: Path, content: bytes) -> None:
+        # NOTE: the cache only speeds things up, failing to write it must never fail the run.
+        with suppress(OSError):
+            CACHE_DIR.mkdir(parents=True, exist_ok=True)
+            fd, tmp_name = tempfile.mkstemp(dir=CACHE_DIR, suffix=".tmp")
+            tmp_path = Path(tmp_name)
+            try:
+                with os.fdopen(fd, "wb") as tmp_file:
+                    tmp_file.write(content)
+                tmp_path.replace(cache_file)
+            finally:
+                tmp_path.unlink(missing_ok=True)
+
     def _select_with_des(self, prompt: str, options: list[dict]) -> dict:
-        choices = [o[self.keys.des] for o in options]
-        choice = inquirer.list_input(prompt, choices=choices)
+        by_des: dict[str, dict] = {}
+        for o in options:
+            # NOTE: keep the first option when descriptions collide, like a linear scan would.
+            by_des.setdefault(o[self.keys.des], o)
+        choice = inquirer.list_input(prompt, choices=list(by_des))
 
-        return next(o for o in options if o[self.keys.des] == choice)
+        return by_des[choice]
 
     def _serialize_course_choices(self, percorso: dict) -> pd.DataFrame:
-        serialized = []
+        teachings_url = self.cineca_base_url(path="insegnamenti")
+        label_key, des_key, periodo_didattico_key = self.keys.label, self.keys.des, self.keys.periodo_didattico
+        rows = []
         for year in percorso["anni"]:
             for teaching in year["insegnamenti"]:
-                intermidiate = []
+                # NOTE: every teaching adds at least one row, so `position` keeps them in catalogue order.
+                position = len(rows)
                 if not teaching["attivita"]:
-                    intermidiate.append(
-                        {
-                            "Year": year["anno"],
-                            "Teaching": teaching[self.keys.label],
-                            "Semester": "",
-                            "CFU": "",
-                            "Name": "N/A",
-                            "Link": "N/A",
-                        },
-                    )
+                    rows.append((position, year["anno"], teaching[label_key], "", "", "N/A", "N/A", ""))
 
                 for activity in teaching["attivita"]:
-                    link = self.cineca_base_url(path=COURSE_PATH_TEMPLATE.format(**activity))
-                    intermidiate.append(
-                        {
-                            "Year": year["anno"],
-                            "Teaching": teaching[self.keys.label],
-                            "Semester": activity.get(self.keys.periodo_didattico, ""),
-                            "CFU": activity["crediti"],
-                            "Name": activity[self.keys.des],
-                            "Link": f'=HYPERLINK("{link}", "{activity["cod"]}")',
-                        },
+                    # NOTE: almost every activity has a teaching period, the lookup is cheaper than `dict.get`.
+                    try:
+                        semester = activity[periodo_didattico_key]
+                    except KeyError:
+                        semester = ""
+
+                    rows.append(
+                        (
+                            position,
+                            year["anno"],
+                            teaching[label_key],
+                            semester,
+                            activity["crediti"],
+                            activity[des_key],
+                            activity["cod"],
+                            course_url(teachings_url, activity),
+                        ),
                     )
-                intermidiate.sort(key=lambda a: a["Semester"])
-                serialized.extend(intermidiate)
 
-        return pd.DataFrame(serialized)
+        rows.sort(key=itemgetter(0, 3))
+        _, years, teachings, semesters, cfus, names, links, urls = zip(*rows, strict=True) if rows else ((),) * 8
+        columns = dict(
+            zip(CATALOGUE_COLUMNS, (years, teachings, semesters, cfus, names, links, urls), strict=True),
+        )
+        return pd.DataFrame(columns, dtype=object, copy=False)
 
 
 def save_to_xlsx(filename: str, df: pd.DataFrame) -> None:
-    with pd.ExcelWriter(filename) as writer:
-        df.to_excel(writer, sheet_name="Sheet1", index=False)
-        for column in df:
-            column_width = max(df[column].astype(str).map(len).max(), len(column))
-            col_idx = df.columns.get_loc(column)
-            writer.sheets["Sheet1"].set_column(col_idx, col_idx, column_width)
+    # NOTE: `df` must have the CATALOGUE_COLUMNS produced by `CourseChooser.get_course_catalogue`, looked up by name.
+    df = df[list(CATALOGUE_COLUMNS)]
+    column_widths = compute_column_widths({column: df[column].to_numpy() for column in SHEET_COLUMNS})
+
+    # NOTE: `constant_memory` flushes every row once the next one is started, rows must be written in order.
+    with xlsxwriter.Workbook(filename, {"constant_memory": True}) as workbook:
+        worksheet = workbook.add_worksheet("Sheet1")
+        for col_idx, column in enumerate(SHEET_COLUMNS):
+            worksheet.set_column(col_idx, col_idx, column_widths[column])
+
+        header_format = workbook.add_format({"bold": True, "border": 1, "align": "center", "valign": "top"})
+        worksheet.write_row(0, 0, SHEET_COLUMNS, header_format)
+        for row_idx, (year, teaching, semester, cfu, name, link, url) in enumerate(
+            df.itertuples(index=False, name=None),
+            start=1,
+        ):
+            # NOTE: the API may return `null` for any of these, `write` turns it into a blank cell.
+            worksheet.write(row_idx, 0, year)
+            worksheet.write(row_idx, 1, teaching)
+            worksheet.write(row_idx, 2, semester)
+            worksheet.write(row_idx, 3, cfu)
+            worksheet.write(row_idx, 4, name)
+            if url:
+                worksheet.write_url(row_idx, 5, url, string=link)
+            else:
+                worksheet.write(row_idx, 5, link)
 
     print(f"Courses saved into {filename}.")
 
@@ -131,9 +259,15 @@ if __name__ == "__main__":
         default=datetime.today().year,
         help="Starting academic year to use to list the courses. (default: %(default)s)",
     )
+    parser.add_argument(
+        "-u",
+        "--university",
+        choices=UNIVERSITIES,
+        help="University whose course catalogue to use, asked interactively if omitted.",
+    )
     args = parser.parse_args()
 
-    config = Config(args.year, args.lang)
+    config = Config(args.year, args.lang, args.university)
 
     cc = CourseChooser(config)
     cod = cc.get_degree()